@@ -17,14 +17,22 @@ operations efficiently without blocking the main execution flow.
 """
 
 # Importing necessary libraries for hardware control and asynchronous operations
-from machine import Pin
+from machine import Pin, PWM, Timer, lightsleep
+from micropython import const
+import micropython
 import time
 import uasyncio
 import ujson
+import uos
+from ucollections import deque
 
 # Configuration values with default settings.
 # These settings are used for various timing operations in the script and can be overridden by an external configuration file.
 CONFIG_FILE = 'config.json'  # Name of the external configuration file.
+CONFIG_TMP_FILE = 'config.json.tmp'  # Temporary file for atomic configuration writes.
+LOG_FILE = 'log.txt'  # Name of the log file for debug messages.
+LOG_OLD_FILE = 'log.old'  # Name of the rotated (previous) log file.
+MAX_LOG_SIZE = const(250 * 1024)  # Maximum size of the log file in bytes before it is rotated.
 CONFIG = {
     'flush_sec': 10,          # Time in seconds for the flush operation.
     'disposal_sec': 60,       # Time in seconds for the disposal operation.
@@ -33,29 +41,251 @@ CONFIG = {
     'water_clean_sec': 5 * 60,      # Time in seconds for water cleaning operation.
 }
 
+# Minimum duration in seconds a filtering run must have lasted before a long
+# button press stores it as the new filtering interval. This avoids saving
+# accidental, uselessly short intervals.
+MIN_FILTER_DURATION = const(30)
+
+# Maximum number of tasks that may wait in the task queue. Further tasks are
+# dropped so that mashing the button cannot queue up work (and memory)
+# indefinitely.
+MAX_PENDING_TASKS = const(4)
+
+# Duration in milliseconds from which a button press counts as a long press.
+BUTTON_LONG_PRESS_MS = const(800)
+
+# Light sleep is entered in slices of this length (in milliseconds) while the
+# system is fully idle and the next flush deadline is far away.
+LIGHTSLEEP_SLICE_MS = const(60 * 1000)
+
+# Only enter light sleep when at least this many seconds remain until the next
+# flush deadline, so the deadline itself is never slept over.
+LIGHTSLEEP_MIN_REMAINING_SEC = const(5 * 60)
+
+# Edges arriving within this window after the previous one are treated as
+# switch bounce and ignored by the button interrupt handler.
+BUTTON_DEBOUNCE_MS = const(20)
+
+# A release is only committed once the contacts have been quiet for this many
+# milliseconds (deferred debouncing as in QMK's sym_defer_g algorithm).
+BUTTON_SETTLE_MS = const(10)
+
+# GPIO pin numbers. Declared via const() so the compiler folds them into the
+# bytecode instead of looking them up in the globals dict at runtime.
+PIN_NUM_BUZZER = const(15)
+PIN_NUM_BUTTON = const(16)
+
+# Tone frequency and on-duty for the buzzer PWM.
+BUZZER_FREQ = const(2000)
+BUZZER_DUTY = const(32768)  # 50% of the 16 bit duty range
+
 # GPIO pin setup for various components connected to the microcontroller.
-PIN_BUZZER = Pin(15, Pin.OUT)  # Buzzer pin, set as output.
-PIN_BUTTON = Pin(16, Pin.IN, Pin.PULL_UP)  # Button pin, set as input with pull-up resistor.
+# The passive piezo buzzer is driven via hardware PWM: the PWM peripheral
+# generates the audible tone on its own, the co-routines only switch the duty
+# cycle on and off at the pattern boundaries.
+PWM_BUZZER = PWM(Pin(PIN_NUM_BUZZER))
+PWM_BUZZER.freq(BUZZER_FREQ)
+PWM_BUZZER.duty_u16(0)
+PIN_BUTTON = Pin(PIN_NUM_BUTTON, Pin.IN, Pin.PULL_UP)  # Button pin, set as input with pull-up resistor.
+
+# Pins for controlling the valves, valve i is driven by entry i of the tuple.
+# The Pin objects mainly serve to configure GPIO 0-3 as outputs at startup; at
+# runtime the valves are switched all at once via the SIO registers in
+# _write_valve_mask(). Keeping the pins in one tuple instead of four separate
+# globals shortens the globals table and allows indexed access where needed.
+PINS_VALVES = tuple(Pin(n, Pin.OUT) for n in (0, 1, 2, 3))
+
+# The four valve pins are GPIO 0-3, i.e. the lowest four bits of the RP2040's
+# SIO GPIO_OUT register. Writing the GPIO_OUT_SET/GPIO_OUT_CLR registers
+# directly lets all four valves switch atomically with a single 32-bit store
+# instead of four separate Pin.value() calls (which would change the valves on
+# different VM ticks).
+SIO_GPIO_OUT_SET = const(0xd0000014)  # atomically sets the masked GPIO output bits
+SIO_GPIO_OUT_CLR = const(0xd0000018)  # atomically clears the masked GPIO output bits
+VALVE_PINS_MASK = const(0b1111)       # GPIO 0-3 drive valves 1-4
+
+# Precomputed (inverted) pin masks for the four fixed valve configurations.
+# Bit i drives valve i+1; a set bit means the pin is high, i.e. the valve is
+# OFF. Folding the boolean arguments of the former _set_valves(v1, v2, v3, v4)
+# into these constants at import time leaves a single register write per
+# configuration change at runtime.
+MASK_CLOSE = const(0b1111)     # all valves off (closed system)
+MASK_FLUSH = const(0b1100)     # valves 1+2 on: flush the osmosis membrane
+MASK_DISPOSAL = const(0b1010)  # valves 1+3 on: discard the first filtered water
+MASK_FILTER = const(0b0110)    # valves 1+4 on: filter water
+
+# In-RAM buffer for debug log messages. Writing to the flash file system on
+# every log call is slow and wears out the flash prematurely, so log lines are
+# collected here and only written out in batches (when the buffer fills up,
+# at task boundaries, or periodically from the _log_flusher() co-routine).
+_LOG_BUF = bytearray()
+_LOG_BUF_LIMIT = const(2048)  # Ask for a flush once the buffer holds this many bytes.
+# Hard cap of the buffer: if flushing keeps failing (e.g. a full or corrupt
+# file system), the oldest messages are dropped beyond this size so that the
+# buffer can never grow into a MemoryError in a control co-routine.
+_LOG_BUF_MAX = const(8192)
+
+# Minimum level a message must have to be logged at all. Messages below this
+# level are discarded before any formatting work is done, so dense tracing
+# calls cost next to nothing when the level is raised.
+LOG_LEVEL = const(1)
+
+# Event used to wake up the _log_flusher() co-routine early once the log
+# buffer has filled up. debug() itself never touches the flash - all file I/O
+# happens in the flusher task, so a slow flash write can never stall the
+# co-routine that emitted the log message.
+_log_event = uasyncio.Event()
+
+# Size of the log file in bytes, tracked in memory so that flush_log() does not
+# have to stat() the file on every flush. The counter is synchronized with the
+# file system once at startup and reset whenever the log file is rotated.
+try:
+    _log_bytes_written = uos.stat(LOG_FILE)[6]
+except OSError:
+    _log_bytes_written = 0
+
+# File handle of the log file, opened once in init() and kept open. Opening a
+# file on the flash file system rescans directory metadata every time, so
+# paying that cost once (and again only after a rotation) is much cheaper than
+# reopening the file for every flush.
+_log_fh = None
+
+# Reusable timestamp template. The digits are poked directly into this buffer
+# for every log line, so no intermediate strings are allocated for the date
+# and time portion of a message.
+_TS_BUF = bytearray(b'0000-00-00 00:00:00')
+
+
+def _fill_timestamp():
+    """
+    Writes the current date and time into the _TS_BUF template.
+
+    Each digit is stored directly as its ASCII code, avoiding the string
+    allocations a %-style format of six integers would cause on every call.
+    """
+    t = time.localtime()
+    year = t[0]
+    _TS_BUF[0] = 48 + year // 1000
+    _TS_BUF[1] = 48 + year // 100 % 10
+    _TS_BUF[2] = 48 + year // 10 % 10
+    _TS_BUF[3] = 48 + year % 10
+    _TS_BUF[5] = 48 + t[1] // 10
+    _TS_BUF[6] = 48 + t[1] % 10
+    _TS_BUF[8] = 48 + t[2] // 10
+    _TS_BUF[9] = 48 + t[2] % 10
+    _TS_BUF[11] = 48 + t[3] // 10
+    _TS_BUF[12] = 48 + t[3] % 10
+    _TS_BUF[14] = 48 + t[4] // 10
+    _TS_BUF[15] = 48 + t[4] % 10
+    _TS_BUF[17] = 48 + t[5] // 10
+    _TS_BUF[18] = 48 + t[5] % 10
+
+
+def debug(message, *args, func='main', level=1):
+    """
+    Appends a timestamped debug message to the in-RAM log buffer.
+
+    The message is formatted with the current date and time and the name of the
+    function it originates from. It is NOT written to the log file directly -
+    the buffer is flushed in batches via flush_log() to keep the number of slow
+    flash writes low. Messages below LOG_LEVEL return before any timestamp or
+    formatting work happens - for that reason, callers should pass a plain
+    %-style format string plus arguments instead of formatting at the call
+    site, so discarded messages cost nothing.
+
+    Args:
+        message (str): The message (or %-style format string) to be logged.
+        *args: Optional arguments interpolated into the message on emission.
+        func (str, optional): Name of the function the message originates from.
+        level (int, optional): Importance of the message; discarded if below
+            LOG_LEVEL.
+    """
+    if level < LOG_LEVEL:
+        return
+    if args:
+        message = message % args
+    # the timestamp goes through the reusable template buffer, only the
+    # function/message part still needs a (single) formatted string
+    _fill_timestamp()
+    _LOG_BUF.extend(_TS_BUF)
+    _LOG_BUF.extend((' -- [%16s] -- %s\n' % (func, message)).encode())
+    if len(_LOG_BUF) >= _LOG_BUF_LIMIT:
+        _log_event.set()
+        if len(_LOG_BUF) > _LOG_BUF_MAX:
+            # the flusher cannot write the buffer out - sacrifice the oldest
+            # messages instead of eating up the heap
+            del _LOG_BUF[:len(_LOG_BUF) - _LOG_BUF_LIMIT]
+
+
+def flush_log():
+    """
+    Writes the buffered log messages to the log file and clears the buffer.
+
+    This is called when the log buffer fills up, periodically from the
+    _log_flusher() co-routine and at the end of the long-running tasks to
+    guarantee that their log messages reach the flash in a timely manner.
+    A failing write (e.g. a full file system) is silently ignored so that
+    logging problems never interrupt the control flow of the valves.
+    """
+    global _LOG_BUF, _log_bytes_written
+    if not _LOG_BUF or _log_fh is None:
+        return
+    try:
+        _log_fh.write(_LOG_BUF)
+        _log_fh.flush()
+        _log_bytes_written += len(_LOG_BUF)
+        _LOG_BUF = bytearray()
+        if _log_bytes_written > MAX_LOG_SIZE:
+            rotate_log_file()
+            _log_bytes_written = 0
+    except OSError:
+        pass
+
+
+def rotate_log_file():
+    """
+    Rotates the log file once it has grown beyond MAX_LOG_SIZE.
+
+    The current log file is simply renamed to LOG_OLD_FILE (replacing a
+    previously rotated file, if any) and a fresh, empty log file is opened.
+    Renaming consists of two cheap directory operations only - in contrast to
+    copying the content line by line, no file data has to be rewritten on the
+    flash.
+    """
+    global _log_fh
+    _log_fh.close()
+    try:
+        uos.remove(LOG_OLD_FILE)
+    except OSError:
+        pass
+    uos.rename(LOG_FILE, LOG_OLD_FILE)
+    _log_fh = open(LOG_FILE, 'ab')
+
 
-# Pins for controlling valves or other actuators.
-PIN_VALVE1 = Pin(0, Pin.OUT)  # Valve 1 control pin.
-PIN_VALVE2 = Pin(1, Pin.OUT)  # Valve 2 control pin.
-PIN_VALVE3 = Pin(2, Pin.OUT)  # Valve 3 control pin.
-PIN_VALVE4 = Pin(3, Pin.OUT)  # Valve 4 control pin.
+async def _log_flusher():
+    """
+    Third main loop that flushes the log buffer to the log file.
 
-# Class representing a dummy placeholder for no actual task.
-# A dummy task is always indicated as "done".
-class DummyTask():
-    def done(self):
-        return True
+    Wakes up every few seconds, or immediately when debug() signals a full
+    buffer via _log_event. All regular log file I/O is concentrated here so
+    that it never blocks the control co-routines.
+    """
+    while True:
+        try:
+            await uasyncio.wait_for(_log_event.wait(), 5)
+        except uasyncio.TimeoutError:
+            pass
+        _log_event.clear()
+        flush_log()
 
 
 # Initialization of Time Tracking and Task Management Variables
 
-# last_flush stores the timestamp of the last automatic flush operation.
-# Initial value of 0 indicates that no flush has occurred yet or the system is 
-# in its initial state.
-last_flush = 0
+# last_activity stores the timestamp at which the last task (flush or
+# filtering) finished. The flush decisions only ever need the time of the most
+# recent activity, so tracking it directly saves recomputing
+# max(last_flush, last_filtering) in every check.
+last_activity = 0
 
 # last_reflush tracks the timestamp of the last reflush operation.
 # A reflush operation takes place after a first filtration interval. It flushes
@@ -69,14 +299,162 @@ last_reflush = 0
 # decide when to perform the next auto flushing.
 last_filtering = 0
 
-# running_task is initialized as a DummyTask() object. 
-# This object represents the current task that is running which can be queried
-# to be finished (or ready) or not.
-running_task = DummyTask()
-
-# running_task_type is set to None, indicating that there is no current task type defined.
-# This variable identifies the type of task currently being executed as string.
-running_task_type = None
+# _filter_start_ms holds the ticks_ms() stamp at which the filter valves of
+# the current filtering task opened. The long-press save in handle_button()
+# measures the stored filtering interval from this point, so an inline
+# membrane flush preceding the filtration does not inflate the saved value.
+# A negative value means the current task has not reached the filtering stage.
+_filter_start_ms = -1
+
+class _Task():
+    """
+    Light-weight record describing one queued valve task.
+
+    The same object travels from the task queue into the completed-task
+    history and is simply filled in along the way, so queuing plus completing
+    a task costs a single allocation in total (instead of one tuple per queue
+    entry and another per history entry). __slots__ keeps the instances small
+    on the MicroPython heap.
+    """
+
+    __slots__ = ('func', 'type', 'args', 'start_time', 'end_time', 'completed')
+
+    def __init__(self, func, task_type, args):
+        self.func = func
+        self.type = task_type
+        self.args = args
+        self.start_time = None
+        self.end_time = None
+        self.completed = False
+
+
+class TaskManager():
+    """
+    Manages the valve tasks of the system as a FIFO queue.
+
+    Only one task (flushing, filtering, ...) may control the valves at any
+    point in time. Tasks are therefore queued via add_task() and executed one
+    after the other by run_next_task(). The manager keeps track of the
+    currently running task (so that it can be cancelled upon a button press)
+    and of a short history of completed tasks.
+    """
+
+    def __init__(self, max_history=10):
+        # set whenever a task finishes; auto_flush() waits on this event (with
+        # a timeout) instead of polling once per second, so it only wakes up
+        # when its deadline has passed or when a task completion makes a
+        # recomputation of that deadline necessary
+        self.task_done_event = uasyncio.Event()
+        # set while no task is running or queued; other co-routines await this
+        # event instead of repeatedly inspecting current_task and task_list
+        self.idle = uasyncio.Event()
+        self.idle.set()
+        # deque instead of a list: popping the oldest entry from a list shifts
+        # all remaining elements, while deque.popleft() is O(1)
+        self.task_list = deque((), 16)
+        # bounded deque: once max_history entries are reached, appending
+        # silently discards the oldest entry, so no manual trimming is needed
+        self.completed_tasks = deque((), max_history)
+        self.current_task = None
+        self.current_task_type = None
+        self.current_task_start = None
+        self.task_running = False
+
+    def add_task(self, task_func, task_type, *args):
+        """
+        Appends a task to the queue and starts the task runner if it is idle.
+
+        A task is silently dropped when a task of the same type is already
+        waiting in the queue or when the queue is full - repeatedly pressing
+        the button while a task is running must not pile up duplicate work.
+
+        Args:
+            task_func (coroutine function): The co-routine to be executed.
+            task_type (str): Type of the task (e.g. 'FLUSHING' or 'FILTERING').
+            *args: Positional arguments that are passed on to task_func.
+        """
+        if any(t.type == task_type for t in self.task_list):
+            debug('task %s already queued, dropping', task_type, func='TaskManager')
+            return
+        if len(self.task_list) >= MAX_PENDING_TASKS:
+            debug('task queue full, dropping %s', task_type, func='TaskManager')
+            return
+        self.task_list.append(_Task(task_func, task_type, args))
+        self.idle.clear()
+        debug('task %s queued', task_type, func='TaskManager')
+        if not self.task_running:
+            uasyncio.create_task(self.run_next_task())
+
+    async def run_next_task(self):
+        """
+        Executes the queued tasks one after the other until the queue is empty.
+
+        The queue is deliberately drained with an iterative loop (and not by
+        awaiting run_next_task() recursively) so that the stack depth stays
+        constant no matter how many tasks are queued.
+        """
+        if self.task_running:
+            return
+        self.task_running = True
+        try:
+            while self.task_list:
+                task = self.task_list.popleft()
+                task.start_time = time.time()
+                self.current_task_type = task.type
+                self.current_task_start = task.start_time
+                self.current_task = uasyncio.create_task(task.func(*task.args))
+                try:
+                    await self.current_task
+                    task.completed = True
+                    self._add_completed_task(task)
+                    debug('task %s completed at %s', task.type, task.end_time, func='TaskManager')
+                except uasyncio.CancelledError:
+                    self._add_completed_task(task)
+                    debug('task %s cancelled at %s', task.type, task.end_time, func='TaskManager')
+                finally:
+                    self.current_task = None
+                    self.current_task_type = None
+                    self.current_task_start = None
+        finally:
+            self.task_running = False
+            self.idle.set()
+
+    def cancel_current_task(self):
+        """
+        Cancels the currently running task (if there is one).
+        """
+        if self.current_task is not None and not self.current_task.done():
+            self.current_task.cancel()
+
+    def _add_completed_task(self, task):
+        """
+        Records a finished task in the bounded history of completed tasks.
+
+        Stamps the end time on the task record and moves it into the history;
+        the 'completed' flag is expected to be set by the caller for tasks
+        that ran to completion (it stays False for cancelled ones).
+
+        Args:
+            task (_Task): The task record that just finished.
+        """
+        task.end_time = time.time()
+        self.completed_tasks.append(task)
+        self.task_done_event.set()
+
+
+# Cache of the parsed configuration and of the JSON payload that was last
+# written to the configuration file. The cache avoids re-reading and re-parsing
+# the file on repeated read_config() calls and allows write_config() to skip
+# the flash write entirely when the configuration has not actually changed
+# (e.g. a long press that saves the same filtering interval again).
+_config_cache = None
+_last_written_config = None
+
+# The configuration schema is fixed, so the JSON payload can be produced with
+# one prepared format string instead of the generic dict walk (and the
+# intermediate allocations) of ujson.dumps().
+_CONFIG_FMT = ('{{"flush_sec": {}, "disposal_sec": {}, "filter_sec": {}, '
+               '"auto_flush_sec": {}, "water_clean_sec": {}}}')
 
 
 def read_config():
@@ -99,12 +477,26 @@ def read_config():
         dictionary. This design choice prioritizes the program's continuous operation, but it may be worth
         logging such errors for debugging and maintenance purposes.
     """
+    global _config_cache, _last_written_config
+    if _config_cache is not None:
+        return _config_cache
+    # probe for the file first: on a fresh board the config does not exist
+    # yet, and an explicit stat() avoids allocating and unwinding an OSError
+    # from open() on that perfectly normal first-boot path
+    try:
+        uos.stat(CONFIG_FILE)
+    except OSError:
+        return {}
     try:
         with open(CONFIG_FILE, 'r') as f:
             config_data = f.read()
             config = ujson.loads(config_data)
+            _config_cache = config
+            _last_written_config = config_data
             return config
-    except OSError:
+    except (OSError, ValueError):
+        # unreadable or corrupt (e.g. truncated by a power loss) config file:
+        # fall back to the defaults instead of crashing at boot
         pass
     return {}
 
@@ -118,71 +510,66 @@ def write_config(config):
     persisting updated configurations externally, making them available for subsequent runs 
     of the program or other related systems.
 
+    The JSON payload is compared against the payload that was last written (or
+    read at startup); if nothing changed, the flash write is skipped entirely.
+
     Args:
         config (dict): A dictionary containing configuration settings to be written.
     """
-    config_data = ujson.dumps(config)
-    with open(CONFIG_FILE, 'w') as f:
+    global _last_written_config
+    config_data = _CONFIG_FMT.format(
+        config['flush_sec'], config['disposal_sec'], config['filter_sec'],
+        config['auto_flush_sec'], config['water_clean_sec'])
+    if config_data == _last_written_config:
+        return
+    # write to a temporary file first and rename it over the old config: the
+    # rename is atomic on the VFS, so a power loss mid-write leaves either the
+    # complete old or the complete new file behind, never a truncated one
+    with open(CONFIG_TMP_FILE, 'w') as f:
         f.write(config_data)
+    uos.rename(CONFIG_TMP_FILE, CONFIG_FILE)
+    _last_written_config = config_data
         
 
-def _set_valves(v1, v2, v3, v4):
+@micropython.viper
+def _write_valve_mask(mask: int):
     """
-    Internal convenient function that ontrols the state of the 4 valves based on the arguments.
+    Internal convenience function that applies a precomputed valve pin mask.
 
-    Each parameter (v1, v2, v3, v4) corresponds to a specific valve and determines its state.
-    The function uses the 'value' method of each PIN_VALVE object to set the state. Notably,
-    the actual state is set to the logical NOT of the input parameters. This implies that a
-    True value in any argument will turn OFF the corresponding valve, and a False will turn it ON.
+    All four valves are switched with a single write to the SIO GPIO_OUT_SET/CLR
+    registers, so the transition happens atomically. Compiled with the viper
+    emitter, the function body boils down to two native register stores
+    instead of interpreted bytecode.
 
     Args:
-        v1, v2, v3, v4 (bool): Boolean values indicating the desired state of valves 1, 2, 3, and 4, 
-                               respectively. True to turn OFF the valve, False to turn it ON.
+        mask (int): 4-bit pin mask, one of the MASK_* constants. A set bit
+                    drives the corresponding pin high, turning the valve OFF.
     """
-    PIN_VALVE1.value(not v1)
-    PIN_VALVE2.value(not v2)
-    PIN_VALVE3.value(not v3)
-    PIN_VALVE4.value(not v4)
-
+    ptr32(SIO_GPIO_OUT_CLR)[0] = VALVE_PINS_MASK & ~mask
+    ptr32(SIO_GPIO_OUT_SET)[0] = mask
 
-def close_valves():
-    """
-    Closes all valves.
 
-    This function calls the _set_valves function with all arguments set to False,
-    effectively turning all the valves ON (closed state) as per the _set_valves logic.
-    """
-    _set_valves(False, False, False, False)
+# Valve configuration states; each state indexes its pin mask in _VALVE_MASKS.
+STATE_CLOSE = const(0)     # all valves closed
+STATE_FLUSH = const(1)     # flush the osmosis membrane
+STATE_DISPOSAL = const(2)  # discard the first filtered water
+STATE_FILTER = const(3)    # filter water
+_VALVE_MASKS = (MASK_CLOSE, MASK_FLUSH, MASK_DISPOSAL, MASK_FILTER)
 
 
-def set_valves_to_flush():
+def apply_valves(state):
     """
-    Configures valves for the flushing operation.
+    Applies the valve configuration identified by one of the STATE_* values.
 
-    This function sets the first two valves to an OFF (open) state and the last two valves 
-    to an ON (closed) state, tailored for the flushing process.
-    """
-    _set_valves(True, True, False, False)
+    A single dispatch through the _VALVE_MASKS table replaces the former four
+    one-line wrapper functions (close_valves, set_valves_to_flush, ...), so a
+    valve transition costs one function frame and one tuple index.
 
-
-def set_valves_to_disposal():
-    """
-    Sets valves configuration for the disposal operation.
-
-    Adjusts the valve states specifically for disposing the filtered water. Here, valves 1 
-    and 3 are set to OFF (open), while valves 2 and 4 are ON (closed).
-    """
-    _set_valves(True, False, True, False)
-
-
-def set_valves_to_filter():
-    """
-    Configures the valves for the filtering process.
-
-    For the filtering operation, this function opens valves 1 and 4 (setting them to OFF),
-    while closing valves 2 and 3 (setting them to ON).
+    Args:
+        state (int): One of STATE_CLOSE, STATE_FLUSH, STATE_DISPOSAL or
+                     STATE_FILTER.
     """
-    _set_valves(True, False, False, True)
+    _write_valve_mask(_VALVE_MASKS[state])
 
 
 def init():
@@ -192,58 +579,83 @@ def init():
     The function outputs messages to indicate the progress of these actions, aiding in debugging and
     monitoring the initialization process.
     """
-    print('Set valves to be closed')
-    close_valves()
+    global _log_fh
+    try:
+        _log_fh = open(LOG_FILE, 'ab')
+    except OSError:
+        pass
+    debug('Set valves to be closed', func='init')
+    apply_valves(STATE_CLOSE)
     CONFIG.update(read_config())
-    print('config read: {}'.format(CONFIG))
+    debug('config read: %s', CONFIG, func='init')
 
 
-async def greeting_beeps():
-    """
-    Plays a sequence of 1x short beep and 1x long beep as a greeting.
-    """
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.1)
-    PIN_BUZZER.value(0)
-    await uasyncio.sleep(0.1)
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.5)
-    PIN_BUZZER.value(0)
+# Beep sequences as plain data: each entry is a duration in milliseconds, the
+# buzzer tone is on for even and off for odd positions. A single co-routine
+# playing these tables replaces four hand-unrolled beep co-routines, which
+# keeps the bytecode footprint small and makes new patterns trivial to add.
+BEEP_GREETING = (100, 100, 500)          # 1x short beep, 1x long beep as a greeting
+BEEP_FINISH = (400, 200, 400, 200, 400)  # 3x long beeps to indicate completion
+
+# Lengths of the single acknowledgement beeps after a short and a long button
+# press. These are emitted via beep_ms() rather than play_beeps() so that the
+# triggered action is dispatched immediately instead of after the beep.
+BEEP_SHORT_MS = const(200)
+BEEP_LONG_MS = const(500)
+
+# One-shot timer that switches the buzzer tone off again after beep_ms().
+_beep_timer = Timer(-1)
+
+# True while play_beeps() is toggling the buzzer. The auto_flush() loop must
+# not enter light sleep while a pattern is playing, as that would freeze the
+# co-routine mid-pattern with the tone latched on.
+_beeps_active = False
 
 
-async def finish_beeps():
+def _beep_off(timer):
     """
-    Plays a sequence of 3x long beeps to indicate completion.
+    Timer callback that switches the buzzer tone off after beep_ms().
     """
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.4)
-    PIN_BUZZER.value(0)
-    await uasyncio.sleep(0.2)
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.4)
-    PIN_BUZZER.value(0)
-    await uasyncio.sleep(0.2)
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.4)
-    PIN_BUZZER.value(0)
+    PWM_BUZZER.duty_u16(0)
 
 
-async def short_beep():
+def beep_ms(duration_ms):
     """
-    Emits a short beep after a short button press.
+    Emits a single beep of the given length without blocking.
+
+    The tone is switched on immediately and a one-shot hardware timer switches
+    it off again, so the caller does not await anything: the action a button
+    press triggers starts right away and the beep finishes on its own even if
+    the surrounding co-routine is cancelled in the meantime.
+
+    Args:
+        duration_ms (int): Length of the beep in milliseconds.
     """
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.2)
-    PIN_BUZZER.value(0)
+    PWM_BUZZER.duty_u16(BUZZER_DUTY)
+    _beep_timer.init(mode=Timer.ONE_SHOT, period=duration_ms, callback=_beep_off)
 
 
-async def long_beep():
+async def play_beeps(pattern):
     """
-    Emits a long beep after a long button press.
+    Plays a beep pattern given as a tuple of durations in milliseconds.
+
+    The buzzer tone is on for the durations at even indices and off for the
+    durations at odd indices, so a pattern alternates between beeps and
+    pauses. The tone itself comes from the PWM peripheral - the co-routine
+    only toggles the duty cycle at the pattern boundaries.
+
+    Args:
+        pattern (tuple): Sequence of durations in milliseconds.
     """
-    PIN_BUZZER.value(1)
-    await uasyncio.sleep(0.5)
-    PIN_BUZZER.value(0)
+    global _beeps_active
+    _beeps_active = True
+    try:
+        for i, duration in enumerate(pattern):
+            PWM_BUZZER.duty_u16(0 if i & 1 else BUZZER_DUTY)
+            await uasyncio.sleep_ms(duration)
+    finally:
+        PWM_BUZZER.duty_u16(0)
+        _beeps_active = False
 
 
 async def flush_filter():
@@ -254,32 +666,34 @@ async def flush_filter():
     It controls the valves' states to facilitate these operations and uses asynchronous sleeping to 
     maintain them for configured durations. The operation timestamps and task types are updated accordingly.
 
-    The function uses global variables 'last_flush' and 'running_task_type' to track the time of the last
-    flush and the current type of task being executed, respectively.
+    The function updates the global variable 'last_activity' to track the time of the last flush.
     """
 
-    # Print the operation's starting message and set the current task type.
-    print('flush_filter')
-    global last_flush, running_task_type
-    running_task_type = 'FLUSHING'        # Update the task type to 'FLUSHING'.
+    # Log the operation's starting message.
+    debug('start flushing', func='flush_filter')
+    global last_activity
 
     try:
         # Start the flushing process of the osmosis membrane.
-        print('  flush osmose membrane')
-        set_valves_to_flush()
+        debug('flush osmose membrane', func='flush_filter')
+        apply_valves(STATE_FLUSH)
         await uasyncio.sleep(CONFIG['flush_sec'])
 
         # Discard the fist part of the filtered water.
-        print('  discard filtered water')
-        set_valves_to_disposal()
+        debug('discard filtered water', func='flush_filter')
+        apply_valves(STATE_DISPOSAL)
         await uasyncio.sleep(CONFIG['disposal_sec'])
 
     finally:
-        # Update the timestamp of the last flush and reset the valves to their closed state.
-        last_flush = time.time()
-        print('  RESET VALVES!')
-        close_valves()
-        print()
+        # Update the timestamp of the last activity and reset the valves to their
+        # closed state - unless another task is already queued, in which case it
+        # will drive the valves itself right away and the close would only add a
+        # redundant relay switch cycle.
+        last_activity = time.time()
+        if not task_manager.task_list:
+            debug('RESET VALVES!', func='flush_filter')
+            apply_valves(STATE_CLOSE)
+        flush_log()
 
 
 async def filter_water(duration_sec=None):
@@ -294,125 +708,261 @@ async def filter_water(duration_sec=None):
         duration_sec (int, optional): The duration for which the water should be filtered. Defaults to None, 
                                       in which case it uses the 'filter_sec' value from CONFIG.
     """
-    global last_filtering, running_task_type
-    print('Start filtering')
-    
+    global last_filtering, last_activity, _filter_start_ms
+    _filter_start_ms = -1
+    debug('Start filtering', func='filter_water')
+
     # Determine the filtering duration based on the provided argument or default configuration.
     if duration_sec is None:
         duration_sec = CONFIG['filter_sec']
         
     # Check if flushing the membrane is required before filtering.
-    flush_needed = time.time() - max(last_flush, last_filtering) > CONFIG['water_clean_sec']
+    flush_needed = time.time() - last_activity > CONFIG['water_clean_sec']
     if flush_needed:
         await flush_filter()
     
     # Execute the filtering process.
     try:
-        running_task_type = 'FILTERING'
-        print('filter water')
-        set_valves_to_filter()
+        debug('filter water', func='filter_water')
+        apply_valves(STATE_FILTER)
+        _filter_start_ms = time.ticks_ms()
         await uasyncio.sleep(duration_sec)
-        print('  filtering done :)')
-        await finish_beeps()
+        debug('filtering done :)', func='filter_water')
+        # fire and forget: the finish jingle plays on its own task, so the
+        # valves close and the task slot frees up without waiting ~2 s for it
+        uasyncio.create_task(play_beeps(BEEP_FINISH))
     finally:
-        # Update the timestamp of the last filtering and reset the valves to their closed state.
+        # Update the timestamps of the last filtering and reset the valves to their
+        # closed state (skipped when a queued task is about to re-set them anyway).
         last_filtering = time.time()
-        print('  RESET VALVES!\n')
-        close_valves()
+        last_activity = last_filtering
+        if not task_manager.task_list:
+            debug('RESET VALVES!', func='filter_water')
+            apply_valves(STATE_CLOSE)
+        flush_log()
 
 
 def is_button_pressed():
     """
     Check if the button is pressed.
-    
+
     Returns:
         bool: True if the button is pressed (LOW state), False otherwise.
     """
     return PIN_BUTTON.value() == 0
 
 
+# Flag used to signal button edges from the interrupt handler to the
+# handle_button() co-routine. Using an interrupt instead of polling the pin
+# every few milliseconds lets the scheduler sleep until the button is actually
+# touched and reduces the press detection latency to the interrupt dispatch.
+_button_flag = uasyncio.ThreadSafeFlag()
+
+# Millisecond timestamps of the last press (falling) and release (rising)
+# edge, written by the button interrupt handler. Taking the timestamps right
+# in the interrupt makes the measured press duration independent of scheduler
+# latency. A negative press timestamp means no unconsumed press exists.
+_press_ticks = -1
+_release_ticks = -1
+
+# Timestamp of the last accepted edge, used to filter out switch bounce
+# directly in the interrupt handler ("relaxing timer" debouncing).
+_last_edge_ticks = 0
+
+
+@micropython.native
+def _button_isr(pin):
+    """
+    Interrupt handler for the button pin, triggered on both edges.
+
+    Edges following the previous one within BUTTON_DEBOUNCE_MS are dropped as
+    switch bounce, so the co-routines never see spurious press/release cycles.
+    Otherwise the edge is timestamped and handle_button() is woken up once a
+    full press/release cycle is complete - following the MicroPython interrupt
+    handler rules, no memory is allocated here.
+    """
+    global _press_ticks, _release_ticks, _last_edge_ticks
+    now = time.ticks_ms()
+    if time.ticks_diff(now, _last_edge_ticks) < BUTTON_DEBOUNCE_MS:
+        return
+    _last_edge_ticks = now
+    if pin.value() == 0:
+        _press_ticks = now
+    else:
+        _release_ticks = now
+        _button_flag.set()
+
+
+PIN_BUTTON.irq(handler=_button_isr, trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, hard=True)
+
+
 async def handle_button():
     """
     First main loop for handling button press events.
+
+    The loop sleeps on _button_flag until the button interrupt signals a
+    complete press/release cycle, so no scheduler wake-ups occur while the
+    button is idle and the press duration is measured from the interrupt
+    timestamps themselves.
     """
-    global running_task
+    global _press_ticks
     while True:
-        # wait for the button to be pressed
-        while not is_button_pressed():
-            await uasyncio.sleep_ms(50)
-        
-        # wait for the button to be released
-        ms_start = time.ticks_ms()
-        while is_button_pressed():
-            await uasyncio.sleep_ms(50)
-        ms_end = time.ticks_ms()
-        ms_duration = ms_end - ms_start
+        # wait for a full press/release cycle
+        await _button_flag.wait()
+        if _press_ticks < 0:
+            # release edge without a recorded press (e.g. after a reset with
+            # the button held down) - nothing to measure
+            continue
+
+        # commit the release only once the contacts have been quiet for a
+        # settle window and the pin really reads released; a bounce that
+        # slipped through the interrupt filter thus cannot end a press
+        # prematurely, it merely updates the release timestamp
+        while True:
+            await uasyncio.sleep_ms(BUTTON_SETTLE_MS)
+            if (time.ticks_diff(time.ticks_ms(), _last_edge_ticks) >= BUTTON_SETTLE_MS
+                    and not is_button_pressed()):
+                break
+
+        # ticks_ms() wraps around, so the duration must be computed with
+        # ticks_diff() instead of a plain subtraction
+        ms_duration = time.ticks_diff(_release_ticks, _press_ticks)
+        _press_ticks = -1
 
         # do the beep
-        long_pressed = ms_duration > 800
+        long_pressed = ms_duration > BUTTON_LONG_PRESS_MS
         if long_pressed:           
-            print('Long button press')
-            await long_beep()
+            debug('Long button press', func='handle_button')
+            beep_ms(BEEP_LONG_MS)
         else:
-            print('Short button press')
-            await short_beep()
+            debug('Short button press', func='handle_button')
+            beep_ms(BEEP_SHORT_MS)
             
         # decide upon the action
-        if not running_task.done():
-            print('Cancel task {}'.format(running_task_type))
-            running_task.cancel()
-            if long_pressed and running_task_type == 'FILTERING':
-                # save the new time interval for filtering
-                CONFIG['filter_sec'] = time.time() - last_filtering
-                write_config(CONFIG)
-                print('  save new time interval: {}'.format(CONFIG['filter_sec']))
-            elif long_pressed and running_task_type == 'FLUSHING':
+        if task_manager.current_task is not None:
+            task_type = task_manager.current_task_type
+            debug('Cancel task %s', task_type, func='handle_button')
+            task_manager.cancel_current_task()
+            if long_pressed and task_type == 'FILTERING' and _filter_start_ms >= 0:
+                # save the new time interval for filtering, measured in ticks
+                # from the moment the filter valves opened: an inline membrane
+                # flush before the filtration must not count towards the
+                # interval, and time.time() only has 1 s resolution and may
+                # step when the RTC is adjusted
+                elapsed_ms = time.ticks_diff(time.ticks_ms(), _filter_start_ms)
+                if elapsed_ms >= MIN_FILTER_DURATION * 1000:
+                    CONFIG['filter_sec'] = elapsed_ms // 1000
+                    write_config(CONFIG)
+                    debug('save new time interval: %s', CONFIG['filter_sec'], func='handle_button')
+            elif long_pressed and task_type == 'FLUSHING':
                 # filter directly the water for a long time
-                print('  long filtering')
-                running_task = event_loop.create_task(filter_water(60 * 60))
-            elif running_task_type == 'FLUSHING':
+                debug('long filtering', func='handle_button')
+                task_manager.add_task(filter_water, 'FILTERING', 60 * 60)
+            elif task_type == 'FLUSHING':
                 # filter directly the water
-                print('  filtering')
-                running_task = event_loop.create_task(filter_water())
+                debug('filtering', func='handle_button')
+                task_manager.add_task(filter_water, 'FILTERING')
         else:
             if long_pressed:
-                running_task = event_loop.create_task(filter_water(60 * 60))
-                print('  long filtering')
+                task_manager.add_task(filter_water, 'FILTERING', 60 * 60)
+                debug('long filtering', func='handle_button')
             else:
-                running_task = event_loop.create_task(filter_water())
-                print('  filtering')
+                task_manager.add_task(filter_water, 'FILTERING')
+                debug('filtering', func='handle_button')
 
 
 async def auto_flush():
     """
     Second main loop to control automatic flush operations of the system.
-    """
-    global last_flush, last_reflush, running_task
+
+    Instead of polling once per second, the loop computes the next flush
+    deadline (auto flush or reflush, whichever comes first) and sleeps exactly
+    until then. A completing task sets the task manager's task_done_event,
+    which wakes the loop early so that the deadline is recomputed from the
+    fresh timestamps.
+    """
+    global last_reflush
+    # bind the time source and the timing settings to locals: LOAD_FAST is a
+    # single bytecode in MicroPython while every CONFIG['...'] access costs a
+    # global lookup plus a dict hash (neither setting changes at runtime)
+    _time = time.time
+    auto_flush_sec = CONFIG['auto_flush_sec']
+    water_clean_sec = CONFIG['water_clean_sec']
     while True:
-        await uasyncio.sleep(1)
-        if not running_task.done():
-            # don't do any flushing if a task is running
+        # compute the next deadline for auto-flushing or reflushing
+        t = _time()
+        deadline = last_activity + auto_flush_sec
+        if last_reflush < last_filtering:
+            deadline = min(deadline, last_filtering + water_clean_sec)
+
+        # sleep until the deadline has passed (or a task completion requires
+        # the deadline to be recomputed)
+        remaining = deadline - t
+        if (remaining > LIGHTSLEEP_MIN_REMAINING_SEC and task_manager.idle.is_set()
+                and _press_ticks < 0 and not _beeps_active):
+            # fully idle with the deadline far away: gate the core down with
+            # light sleep in one-minute slices instead of keeping the
+            # scheduler spinning at full clock. The button interrupt wakes
+            # the MCU immediately; the yield below hands the scheduler to the
+            # other co-routines before the loop re-evaluates, and the pending
+            # press keeps light sleep off until handle_button() consumed it.
+            flush_log()
+            lightsleep(LIGHTSLEEP_SLICE_MS)
+            await uasyncio.sleep_ms(0)
+            continue
+        if remaining > LIGHTSLEEP_MIN_REMAINING_SEC:
+            # the deadline is far away but a pending press or a playing beep
+            # pattern blocks light sleep - yield in short slices until the
+            # system has quieted down, then re-evaluate
+            await uasyncio.sleep_ms(100)
+            continue
+        if remaining > 0:
+            task_manager.task_done_event.clear()
+            try:
+                await uasyncio.wait_for(task_manager.task_done_event.wait(), remaining)
+                continue
+            except uasyncio.TimeoutError:
+                pass
+        if not task_manager.idle.is_set():
+            # don't do any flushing if a task is running or queued - sleep on
+            # the idle event until the task manager has drained its queue
             # ... the program should never come to this point here ;)
+            await task_manager.idle.wait()
             continue
-        
+
         # check whether we need to do some auto-flushing
-        t = time.time()
-        auto_flush_needed = t - max(last_flush, last_filtering) > CONFIG['auto_flush_sec']
-        reflush_needed = t - last_filtering > CONFIG['water_clean_sec'] and last_reflush < last_filtering
+        t = _time()
+        auto_flush_needed = t - last_activity > auto_flush_sec
+        reflush_needed = t - last_filtering > water_clean_sec and last_reflush < last_filtering
         if reflush_needed or auto_flush_needed:
             if reflush_needed:
                 last_reflush = t
-                print('REFLUSHING')
+                debug('REFLUSHING', func='auto_flush')
             else:
-                print('FLUSHING')
-            running_task = event_loop.create_task(flush_filter())
+                debug('FLUSHING', func='auto_flush')
+            task_manager.add_task(flush_filter, 'FLUSHING')
+        else:
+            await uasyncio.sleep(1)
+
+
+async def _main():
+    """
+    Entry co-routine: plays the greeting and starts all main loops.
+
+    Using uasyncio.run() with explicitly created tasks replaces the deprecated
+    get_event_loop()/run_until_complete()/run_forever() trio and its legacy
+    compatibility wrappers in current uasyncio versions.
+    """
+    await play_beeps(BEEP_GREETING)
+    uasyncio.create_task(_log_flusher())
+    uasyncio.create_task(handle_button())
+    uasyncio.create_task(auto_flush())
+    while True:
+        await uasyncio.sleep(3600)
 
 
 # init and run all co-routines
 init()
-event_loop = uasyncio.get_event_loop()
-event_loop.run_until_complete(greeting_beeps())
-event_loop.create_task(handle_button())
-event_loop.create_task(auto_flush())
-event_loop.run_forever()
+task_manager = TaskManager()
+uasyncio.run(_main())
 